@@ -0,0 +1,266 @@
+import json
+import time
+import uuid
+import random
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import tenants
+
+
+class FakeWorld:
+    '''In-memory state of the Google services of all fake tenants, with API call counters.'''
+
+    def __init__(self, tags=("Salsa", "Bachata"), events_per_tag=8, contacts_per_tag=20, api_latency=0.0, seed=0):
+        self.tags = list(tags)
+        self.events_per_tag = events_per_tag
+        self.contacts_per_tag = contacts_per_tag
+        self.api_latency = api_latency # seconds per simulated API call
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.emails = [] # (tenant, raw message)
+        self.calendars = defaultdict(dict) # calendar id -> event id -> event
+        self.sheets = {} # spreadsheet id -> sheet title -> values
+        self.blobs = defaultdict(dict) # bucket name -> blob name -> data
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def populate(self, tenant):
+        '''Create admin calendar events and contact sheets of a tenant.'''
+        now = datetime.now().astimezone()
+        events = self.calendars[tenant.admin_calendar_id]
+        sheets = self.sheets.setdefault(tenant.contacts_spreadsheet_id, {})
+
+        for tag in self.tags:
+            for i in range(self.events_per_tag):
+                start = (now + timedelta(days=i * 3 + 1)).replace(hour=19, minute=0, second=0, microsecond=0)
+                event_id = uuid.uuid4().hex
+                events[event_id] = {
+                    'id': event_id,
+                    'summary': f"[{tag}] Kurs {i + 1}",
+                    'created': now.isoformat(),
+                    'start': {'dateTime': start.isoformat()},
+                    'end': {'dateTime': (start + timedelta(hours=1)).isoformat()},
+                }
+
+            values = [["Name", "E-mail", "Whatsapp", "Preference"]]
+            for i in range(self.contacts_per_tag):
+                preference = "email" if i % 4 else "whatsapp"
+                values.append([f"{tag} Person {i}", f"{tag.lower()}{i}@example.com", f"+43{i:08d}", preference])
+            sheets[tag] = values
+
+    def mutate(self, tenant):
+        '''Move a random admin event by a day, as an admin editing the calendar would.'''
+        with self.lock:
+            events = self.calendars[tenant.admin_calendar_id]
+            if not events:
+                return
+            event = events[self.random.choice(list(events))]
+            for key in ('start', 'end'):
+                moved = datetime.fromisoformat(event[key]['dateTime']) + timedelta(days=1)
+                event[key] = {'dateTime': moved.isoformat()}
+
+
+class FakeRequest:
+    def __init__(self, world, name, fn):
+        self.world = world
+        self.name = name
+        self.fn = fn
+
+    def execute(self):
+        self.world.call(self.name)
+        return self.fn()
+
+
+class FakeResource:
+    '''Chainable stand-in for a discovery resource, e.g. `service.events().list(...)`.'''
+
+    def __init__(self, methods):
+        self._methods = methods
+
+    def __getattr__(self, name):
+        try:
+            return self._methods[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeBatch:
+    def __init__(self, world, callback):
+        self.world = world
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.world.call("gmail.batch")
+        for request_id, request in self.requests:
+            self.callback(request_id, request.fn(), None)
+
+
+def _in_range(event, time_min, time_max):
+    start = datetime.fromisoformat(event['start'].get('dateTime', event['start'].get('date')))
+    if start.tzinfo is None:
+        start = start.astimezone()
+    return datetime.fromisoformat(time_min) <= start <= datetime.fromisoformat(time_max)
+
+
+def fake_calendar_service(world):
+    def events_list(calendarId, timeMin, timeMax, **kwargs):
+        def run():
+            with world.lock:
+                events = [dict(event) for event in world.calendars[calendarId].values()]
+            return {'items': [event for event in events if _in_range(event, timeMin, timeMax)]}
+        return FakeRequest(world, "calendar.events.list", run)
+
+    def events_insert(calendarId, body):
+        def run():
+            with world.lock:
+                world.calendars[calendarId][body['id']] = dict(body)
+            return body
+        return FakeRequest(world, "calendar.events.insert", run)
+
+    def calendars_insert(body):
+        return FakeRequest(world, "calendar.calendars.insert", lambda: dict(body, id=uuid.uuid4().hex))
+
+    return FakeResource({
+        'events': lambda: FakeResource({'list': events_list, 'insert': events_insert}),
+        'calendars': lambda: FakeResource({'insert': calendars_insert}),
+        'close': lambda: None,
+    })
+
+
+def fake_sheets_service(world):
+    def values_for(spreadsheet_id, range_):
+        sheets = world.sheets.get(spreadsheet_id, {})
+        title = range_.split('!')[0] if '!' in range_ else next(iter(sheets), None)
+        if title not in sheets: # like the Sheets API, fail the whole request
+            raise HttpError(httplib2.Response({'status': 400}), f"Unable to parse range: {range_}".encode())
+        return [list(row) for row in sheets[title]]
+
+    def values_get(spreadsheetId, range):
+        return FakeRequest(world, "sheets.values.get", lambda: {'values': values_for(spreadsheetId, range)})
+
+    def values_batch_get(spreadsheetId, ranges):
+        return FakeRequest(world, "sheets.values.batchGet", lambda: {
+            'valueRanges': [{'range': range_, 'values': values_for(spreadsheetId, range_)} for range_ in ranges]
+        })
+
+    def values_append(spreadsheetId, range, valueInputOption, body):
+        def run():
+            with world.lock:
+                world.sheets.setdefault(spreadsheetId, {}).setdefault(range, []).extend(body['values'])
+            return {'updates': {'updatedRows': len(body['values'])}}
+        return FakeRequest(world, "sheets.values.append", run)
+
+    def spreadsheets_get(spreadsheetId):
+        return FakeRequest(world, "sheets.spreadsheets.get", lambda: {
+            'sheets': [{'properties': {'title': title}} for title in world.sheets.get(spreadsheetId, {})]
+        })
+
+    values = FakeResource({'get': values_get, 'batchGet': values_batch_get, 'append': values_append})
+    spreadsheets = FakeResource({'values': lambda: values, 'get': spreadsheets_get})
+    return FakeResource({'spreadsheets': lambda: spreadsheets, 'close': lambda: None})
+
+
+def fake_gmail_service(world, tenant_name):
+    def messages_send(userId, body):
+        def run():
+            with world.lock:
+                world.emails.append((tenant_name, body['raw']))
+            return {'id': uuid.uuid4().hex}
+        return FakeRequest(world, "gmail.messages.send", run)
+
+    messages = FakeResource({'send': messages_send})
+    users = FakeResource({'messages': lambda: messages})
+    return FakeResource({
+        'users': lambda: users,
+        'new_batch_http_request': lambda callback: FakeBatch(world, callback),
+        'close': lambda: None,
+    })
+
+
+class FakeBlob:
+    def __init__(self, world, bucketname, name):
+        self.world = world
+        self.bucketname = bucketname
+        self.name = name
+
+    def download_as_string(self):
+        self.world.call("storage.download")
+        return self.world.blobs[self.bucketname][self.name]
+
+    def upload_from_string(self, data, content_type=None):
+        self.world.call("storage.upload")
+        if isinstance(data, str):
+            data = data.encode()
+        with self.world.lock:
+            self.world.blobs[self.bucketname][self.name] = data
+
+
+class FakeBucket:
+    def __init__(self, world, name):
+        self.world = world
+        self.name = name
+
+    def get_blob(self, name):
+        self.world.call("storage.get_blob")
+        if name in self.world.blobs[self.name]:
+            return FakeBlob(self.world, self.name, name)
+        return None
+
+    def blob(self, name):
+        return FakeBlob(self.world, self.name, name)
+
+
+class FakeTenant(tenants.Tenant):
+    '''Tenant backed by a FakeWorld instead of Google services.'''
+
+    world = None # set by install()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        world = self.world
+        self._services.update({
+            'calendar': fake_calendar_service(world),
+            'sheets': fake_sheets_service(world),
+            'gmail': fake_gmail_service(world, self.name),
+            'bucket': FakeBucket(world, self.bucketname),
+        })
+
+        world.populate(self)
+
+
+def install(world, tenants_file=None):
+    '''Make the management service build fake tenants; call before importing main.'''
+    FakeTenant.world = world
+    tenants.Tenant = FakeTenant
+    if tenants_file:
+        tenants.TENANTS_FILE = tenants_file
+
+
+def write_tenants_file(path, names):
+    configs = [{
+        'name': name,
+        'token_file': "token.json",
+        'project_id': "fake-project",
+        'bucketname': f"bucket-{i}",
+        'contacts_spreadsheet_id': f"contacts-{i}",
+        'admin_calendar_id': f"admin-{i}",
+        'sender_email': f"studio{i}@example.com",
+    } for i, name in enumerate(names)]
+    with open(path, 'w') as f:
+        json.dump(configs, f)
@@ -0,0 +1,282 @@
+'''
+Replay recorded webhook traffic against the management service backed by fake Google services.
+
+Record real traffic by setting RECORD_REQUESTS_FILE on the deployed service (on Cloud Run set
+it to "-" and export the logged requests, see main.record_request), or generate it:
+
+    python loadtest.py generate traffic.jsonl --notifications 200 --rate 5 --tenants 3
+    python loadtest.py replay traffic.jsonl --speedup 10 --concurrency 8 --api-latency 0.05
+
+Tenants are taken from the recording (channel id prefixes and `tenant` fields), or from the
+production tenants file with --tenants-file.
+
+Measure cold start (import of the service, loading and refreshing the credentials, first use
+of the Google clients) in fresh processes; without --token the credentials step is skipped:
+
+    python loadtest.py startup --runs 10 --token token.json
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import fakes
+from tenants import DEFAULT_TENANT, CHANNEL_SEPARATOR
+
+
+def tenant_names(count):
+    if count > 1:
+        return [f"tenant-{i}" for i in range(count)]
+    return [DEFAULT_TENANT]
+
+
+def recorded_tenant_names(records):
+    '''Tenants addressed by recorded requests, by channel id prefix or `tenant` field.'''
+    names = set()
+    for record in records:
+        channel_id = record['headers'].get('X-Goog-Channel-Id')
+        if channel_id and CHANNEL_SEPARATOR in channel_id:
+            names.add(channel_id.rsplit(CHANNEL_SEPARATOR, 1)[0])
+        if record['body'] and record['headers'].get('Content-Type', '').startswith('application/json'):
+            name = json.loads(record['body']).get('tenant')
+            if name:
+                names.add(name)
+    return sorted(names) or [DEFAULT_TENANT]
+
+
+def load_app(world, names=None, tenants_file=None):
+    '''
+    Import the management service with fake tenants, configured by `tenants_file`
+    (e.g. the production one) or named `names`.
+    '''
+    if tenants_file is None and names and names != [DEFAULT_TENANT]:
+        tenants_file = os.path.join(tempfile.mkdtemp(), "tenants.json")
+        fakes.write_tenants_file(tenants_file, names)
+    fakes.install(world, tenants_file)
+
+    import main as service
+    logging.getLogger().setLevel(logging.WARNING) # main logs every notification
+    return service
+
+
+def load_records(path):
+    '''
+    Records written to RECORD_REQUESTS_FILE, or the log entries of RECORD_REQUESTS_FILE="-"
+    exported with `gcloud logging read 'jsonPayload.recorded_request:*' --format=json`.
+    '''
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['): # exported log entries
+        entries = json.loads(text)
+    else:
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+    
+    records = []
+    for entry in entries:
+        if 'jsonPayload' in entry:
+            entry = entry['jsonPayload']
+        records.append(entry.get('recorded_request', entry))
+    records.sort(key=lambda record: record['time'])
+    return records
+
+
+def generate_records(notifications=100, schedules=0, rate=1.0, tenant_count=1, seed=0):
+    '''Synthetic traffic: Poisson arrivals of calendar notifications and schedule requests.'''
+    rng = random.Random(seed)
+    names = tenant_names(tenant_count)
+    paths = ['/notifications'] * notifications + ['/schedule'] * schedules
+    rng.shuffle(paths)
+
+    records = []
+    now = time.time()
+    for path in paths:
+        now += rng.expovariate(rate)
+        tenant = rng.choice(names)
+        if path == '/notifications':
+            headers = {
+                'X-Goog-Resource-State': 'exists',
+                'X-Goog-Channel-Id': f"{tenant}_{uuid.uuid4().hex}",
+                'X-Goog-Resource-Id': uuid.uuid4().hex,
+                'X-Goog-Resource-Uri': f"https://www.googleapis.com/calendar/v3/calendars/admin/events",
+            }
+            body = ''
+        else:
+            headers = {'Content-Type': 'application/json'}
+            body = json.dumps({'tenant': tenant})
+        records.append({'time': now, 'method': 'POST', 'path': path, 'headers': headers, 'body': body})
+    return records
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def replay(service, world, records, speedup=1.0, concurrency=1, mutate=False):
+    '''
+    Send `records` to the app, keeping their relative timing divided by `speedup`.
+
+    Latency is measured from the scheduled arrival time, so waiting for a free
+    worker (the Cloud Run concurrency limit) counts towards it.
+    '''
+    first = records[0]['time']
+    start = time.perf_counter()
+
+    def send(record):
+        scheduled = start + (record['time'] - first) / speedup
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        if mutate and record['path'] == '/notifications':
+            tenant = service.tenants.for_channel(record['headers'].get('X-Goog-Channel-Id'))
+            if tenant:
+                world.mutate(tenant)
+
+        response = service.app.test_client().open(
+            record['path'], method=record.get('method', 'POST'), headers=record['headers'], data=record['body']
+        )
+        return time.perf_counter() - scheduled, response.status_code
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, records))
+
+    return {
+        'wall': time.perf_counter() - start,
+        'latencies': [latency for latency, _ in results],
+        'statuses': Counter(status for _, status in results),
+    }
+
+
+def report(result, world):
+    latencies = result['latencies']
+    print(f"Requests:     {len(latencies)} in {result['wall']:.2f}s ({len(latencies) / result['wall']:.1f} req/s)")
+    print(f"Statuses:     {dict(result['statuses'])}")
+    print("Latency (ms): " + ", ".join(
+        f"p{p} {percentile(latencies, p) * 1000:.1f}" for p in (50, 90, 99)
+    ) + f", max {max(latencies) * 1000:.1f}")
+    print(f"API calls:    {sum(world.calls.values())}")
+    for name, count in sorted(world.calls.items()):
+        print(f"    {name}: {count}")
+    print(f"Emails:       {len(world.emails)}")
+
+
+STARTUP_SCRIPT = '''
+import os
+import time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import Request
+tenant = main.tenants.get()
+token_file = os.getenv("STARTUP_TOKEN_FILE")
+if token_file: # as on the first request: load the token file and refresh the access token
+    tenant.token_file = token_file
+    tenant.credentials.refresh(Request())
+    loaded = time.perf_counter()
+else: # no token needed to build the clients
+    tenant._services['credentials'] = AnonymousCredentials()
+    loaded = None
+tenant.calendar_service, tenant.spreadsheets, tenant.gmail_service, tenant.bucket
+built = time.perf_counter()
+
+print(imported - start, loaded - imported if loaded else "nan", built - (loaded or imported))
+'''
+
+
+def measure_startup(runs=5, token_file=None):
+    '''Time `import main`, the credentials and the first use of the Google clients, each run in a fresh interpreter.'''
+    env = dict(os.environ, TENANTS_FILE="") # single default tenant from the constants in main.py
+    if token_file:
+        env["STARTUP_TOKEN_FILE"] = os.path.abspath(token_file)
+    imports, credentials, builds = [], [], []
+    for _ in range(runs):
+        process = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT], cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env, capture_output=True, text=True
+        )
+        if process.returncode:
+            raise SystemExit(f"Startup run failed:\n{process.stderr}")
+        output = process.stdout.split()
+        imports.append(float(output[-3]))
+        credentials.append(float(output[-2]))
+        builds.append(float(output[-1]))
+    return imports, credentials, builds
+
+
+def report_startup(imports, credentials, builds):
+    for name, values in (("Import", imports), ("Credentials", credentials), ("First use", builds)):
+        if any(value != value for value in values): # nan
+            print(f"{name + ':':<14}not measured, pass --token")
+            continue
+        print(f"{name + ':':<14}median {statistics.median(values) * 1000:.1f} ms, min {min(values) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help="write synthetic traffic")
+    generate.add_argument('output')
+    generate.add_argument('--notifications', type=int, default=100)
+    generate.add_argument('--schedules', type=int, default=0)
+    generate.add_argument('--rate', type=float, default=1.0, help="requests per second")
+    generate.add_argument('--tenants', type=int, default=1)
+    generate.add_argument('--seed', type=int, default=0)
+
+    replay_ = subparsers.add_parser('replay', help="replay recorded or generated traffic")
+    replay_.add_argument('input')
+    replay_.add_argument('--speedup', type=float, default=1.0)
+    replay_.add_argument('--concurrency', type=int, default=1)
+    replay_.add_argument('--tenants-file', help="tenants.json of the recorded deployment (default: tenants from the recording)")
+    replay_.add_argument('--api-latency', type=float, default=0.0, help="seconds per fake API call")
+    replay_.add_argument('--events-per-tag', type=int, default=8)
+    replay_.add_argument('--contacts-per-tag', type=int, default=20)
+    replay_.add_argument('--mutate', action='store_true', help="move an event before each notification")
+
+    startup = subparsers.add_parser('startup', help="measure cold start")
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--token', help="authorized user token file, to include loading and refreshing the credentials")
+
+    args = parser.parse_args()
+
+    if args.command == 'startup':
+        report_startup(*measure_startup(args.runs, args.token))
+        return
+
+    if args.command == 'generate':
+        records = generate_records(args.notifications, args.schedules, args.rate, args.tenants, args.seed)
+        with open(args.output, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        print(f"Wrote {len(records)} requests to {args.output}")
+        return
+
+    world = fakes.FakeWorld(
+        events_per_tag=args.events_per_tag, contacts_per_tag=args.contacts_per_tag, api_latency=args.api_latency
+    )
+    records = load_records(args.input)
+    if not records:
+        print("No requests to replay")
+        return
+
+    app_module = load_app(world, recorded_tenant_names(records), args.tenants_file)
+    world.calls.clear() # don't count setup
+
+    result = replay(app_module, world, records, speedup=args.speedup, concurrency=args.concurrency, mutate=args.mutate)
+    report(result, world)
+
+
+if __name__ == "__main__":
+    main()
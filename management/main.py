@@ -5,19 +5,19 @@ import base64
 import uuid
 import sys
 import logging
+import time
+import threading
 from datetime import datetime, timedelta
 from collections import defaultdict
 
 from flask import Flask, request, jsonify
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from google.cloud import storage
 from googleapiclient.errors import HttpError
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import pandas as pd
 
 from templates import *
+from tenants import Tenant, TenantRegistry, FairScheduler, TENANTS_FILE, DEFAULT_TENANT
 
 # Flask app setup
 app = Flask(__name__)
@@ -25,56 +25,81 @@ app = Flask(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 
+# single tenant configuration, used when there is no tenants file (see tenants.py)
 SERVICE_ACCOUNT_FILE = "token.json"
-SCOPES = [
-    "https://www.googleapis.com/auth/spreadsheets.readonly", 
-    "https://www.googleapis.com/auth/calendar.events.owned", 
-    "https://www.googleapis.com/auth/gmail.compose",
-    "https://www.googleapis.com/auth/devstorage.read_write"
-]
-
 PROJECT_ID = "TEMPLATE-PROJECT-ID"
 BUCKETNAME = "TEMPLATE-BUCKETNAME"
 CONTACTS_SPREADSHEET_ID = "TEMPLATE-SPREADSHEET-ID"
 SPREADSHEET_RANGE = "A:C" # name, email, whatsapp
 ADMIN_CALENDAR_ID = "TEMPLATE-CALENDAR-ID"
-CALENDAR_ID_MAPPING = {}
 SENDER_EMAIL = "TEMPLATE-EMAIL"
 
 PER_TAG = True
 
-# Initialize Google services
-credentials = Credentials.from_authorized_user_file(SERVICE_ACCOUNT_FILE, SCOPES)
-calendar_service = build("calendar", "v3", credentials=credentials)
-sheets_service = build("sheets", "v4", credentials=credentials)
-spreadsheets = sheets_service.spreadsheets()
-gmail_service = build("gmail", 'v1', credentials=credentials)
-storage_client = storage.Client(project=PROJECT_ID, credentials=credentials)
-bucket = storage_client.get_bucket(BUCKETNAME)
+TENANT_WORKERS = int(os.getenv("TENANT_WORKERS", 4))
+RECORD_REQUESTS_FILE = os.getenv("RECORD_REQUESTS_FILE") # JSON lines of incoming requests, replayed by loadtest.py; "-" logs them instead (Cloud Run)
+RECORDED_PATHS = ('/notifications', '/schedule', '/digest')
+
+# Initialize tenants, their Google services are created on first use
+if os.path.exists(TENANTS_FILE):
+    tenants = TenantRegistry.from_file(TENANTS_FILE)
+else:
+    tenants = TenantRegistry([
+        Tenant(DEFAULT_TENANT, SERVICE_ACCOUNT_FILE, PROJECT_ID, BUCKETNAME, CONTACTS_SPREADSHEET_ID, ADMIN_CALENDAR_ID, SENDER_EMAIL)
+    ])
+scheduler = FairScheduler(workers=TENANT_WORKERS)
 
 
 #region helper functions
-def update_calendar_mapping():
-    global CALENDAR_ID_MAPPING
+record_lock = threading.Lock()
+
+@app.before_request
+def record_request():
+    '''
+    Append incoming requests (headers, body and arrival time) to RECORD_REQUESTS_FILE.
+    
+    On Cloud Run every instance has its own in-memory filesystem, lost on scale down, so set
+    RECORD_REQUESTS_FILE to "-" there: each request is written to stdout as a structured log
+    line, export them with `gcloud logging read 'jsonPayload.recorded_request:*' --format=json`.
+    '''
+    if not RECORD_REQUESTS_FILE or request.path not in RECORDED_PATHS:
+        return
+    
+    record = {
+        'time': time.time(),
+        'method': request.method,
+        'path': request.path,
+        'headers': {key: value for key, value in request.headers.items() if key.startswith('X-Goog-') or key == 'Content-Type'},
+        'body': request.get_data(as_text=True),
+    }
+    with record_lock:
+        if RECORD_REQUESTS_FILE == '-':
+            print(json.dumps({'severity': 'INFO', 'message': 'recorded request', 'recorded_request': record}), flush=True)
+            return
+        with open(RECORD_REQUESTS_FILE, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+def update_calendar_mapping(tenant):
+    calendar_id_mapping = tenant.calendar_id_mapping
     
     # get calendar ids from calendar bucket
-    blob = bucket.get_blob('calendar_mapping.json')
+    blob = tenant.bucket.get_blob('calendar_mapping.json')
     if blob:
         calendar_mapping = json.loads(blob.download_as_string())
     else:   
         calendar_mapping = dict()
         
-    new_in_bucket = set(calendar_mapping.keys()) - set(CALENDAR_ID_MAPPING.keys())
+    new_in_bucket = set(calendar_mapping.keys()) - set(calendar_id_mapping.keys())
     
     for key in new_in_bucket:
-        CALENDAR_ID_MAPPING[key] = calendar_mapping[key]
+        calendar_id_mapping[key] = calendar_mapping[key]
     
     # update bucket
     if blob:
-        blob.upload_from_string(json.dumps(CALENDAR_ID_MAPPING), content_type='application/json')
+        blob.upload_from_string(json.dumps(calendar_id_mapping), content_type='application/json')
     else:
-        blob = bucket.blob('calendar_mapping.json')
-        blob.upload_from_string(json.dumps(CALENDAR_ID_MAPPING), content_type='application/json')
+        blob = tenant.bucket.blob('calendar_mapping.json')
+        blob.upload_from_string(json.dumps(calendar_id_mapping), content_type='application/json')
 
 #endregion
 
@@ -90,21 +115,48 @@ def create_email_message(sender, to, subject, body):
     raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
     return {'raw': raw_message}
 
-def send_email(sender, to, subject, body):
+def send_email(tenant, sender, to, subject, body):
     """Send an email message."""
     try:
         if isinstance(to, list):
             to = ', '.join(to)
         message = create_email_message(sender, to, subject, body)
-        message = gmail_service.users().messages().send(userId="me", body=message).execute()
+        message = tenant.gmail_service.users().messages().send(userId="me", body=message).execute()
         logging.info(f'Sent message to {to} Message Id: {message["id"]}')
     except HttpError as error:
         logging.info(f'An error occurred: {error}')
+
+def send_emails_bulk(tenant, messages, batch_size=50):
+    """Send many email messages through Gmail batch requests.
+    
+    `messages` is a list of dicts with `sender`, `to`, `subject` and `body` keys.
+    Returns the indices of the messages that could not be sent.
+    """
+    failed = []
+    
+    def callback(request_id, response, exception):
+        if exception is not None:
+            logging.info(f'An error occurred for {request_id}: {exception}')
+            failed.append(int(request_id))
+        else:
+            logging.info(f'Sent message {request_id} Message Id: {response["id"]}')
+    
+    for i in range(0, len(messages), batch_size): # gmail recommends at most 50 requests per batch
+        batch = tenant.gmail_service.new_batch_http_request(callback=callback)
+        for j, message in enumerate(messages[i:i + batch_size]):
+            to = message['to']
+            if isinstance(to, list):
+                to = ', '.join(to)
+            body = create_email_message(message['sender'], to, message['subject'], message['body'])
+            batch.add(tenant.gmail_service.users().messages().send(userId="me", body=body), request_id=str(i + j))
+        batch.execute()
+    
+    return sorted(failed)
 #endregion
 
 #region calendar functions
-def fetch_all_events(calendar_id, days=60):
-    events_result = calendar_service.events().list(
+def fetch_all_events(tenant, calendar_id, days=60):
+    events_result = tenant.calendar_service.events().list(
         calendarId=calendar_id,
         timeMin=datetime.now().astimezone().isoformat(),
         timeMax=(datetime.now() + timedelta(days=days)).astimezone().isoformat(),
@@ -119,7 +171,7 @@ def fetch_all_events(calendar_id, days=60):
 
     return events
 
-def fetch_events_history(tag=None):
+def fetch_events_history(tenant, tag=None):
     events_history = None
     
     if tag and tag != 'Admin':
@@ -127,14 +179,14 @@ def fetch_events_history(tag=None):
     else:
         filename = 'events_history.json'
     
-    blob = bucket.get_blob(filename)
+    blob = tenant.bucket.get_blob(filename)
     if blob:
         events_history = json.loads(blob.download_as_string())
 
     return events_history
 
-def fetch_old_events(calendar_id, days=60):
-    events_result = calendar_service.events().list(
+def fetch_old_events(tenant, calendar_id, days=60):
+    events_result = tenant.calendar_service.events().list(
         calendarId=calendar_id,
         timeMin=(datetime.now() - timedelta(days=days)).astimezone().isoformat(),
         timeMax=(datetime.now() - timedelta(days=7)).astimezone().isoformat(),
@@ -148,68 +200,132 @@ def fetch_old_events(calendar_id, days=60):
 #endregion
 
 #region notification functions
-def notify(events, note_type="schedule", notify_tag=None): # schedule, update, delete
+def get_event_tag(event):
+    tag = re.search(r'\[(.*)\]', event['summary'])
+    return tag.group(1) if tag else None
+
+def group_events_by_tag(events):
     events_per_tag = defaultdict(list)
     for event in events:
-        title = event['summary']
-        tag = re.search(r'\[(.*)\]', title)
-        tag = tag.group(1) if tag else None
+        events_per_tag[str(get_event_tag(event))].append(event)
+    return events_per_tag
+
+def fetch_contacts(tenant, tags):
+    """Load contacts for all tags with a single batchGet call.
+    
+    Tags without a sheet are dropped, a single unknown range fails the whole batchGet.
+    """
+    sheets = tenant.spreadsheets.get(spreadsheetId=tenant.contacts_spreadsheet_id).execute()['sheets']
+    sheet_names = set(sheet['properties']['title'] for sheet in sheets)
+    
+    tags = list(tags)
+    missing = [tag for tag in tags if tag != str(None) and tag not in sheet_names]
+    if missing:
+        logging.info("No contacts sheet for tags %s", missing)
+    tags = [tag for tag in tags if tag not in missing]
+    if not tags:
+        return {}
+    
+    ranges = [f"{tag}!{SPREADSHEET_RANGE}" if tag != str(None) else f"{SPREADSHEET_RANGE}" for tag in tags]
+    result = tenant.spreadsheets.values().batchGet(spreadsheetId=tenant.contacts_spreadsheet_id, ranges=ranges).execute()
+    value_ranges = result.get('valueRanges', [])
+    
+    # value ranges are returned in the order of the requested ranges
+    return {tag: value_range.get('values', []) for tag, value_range in zip(tags, value_ranges)}
+
+def get_email_recipients(values):
+    # get preferred contact method
+    df = pd.DataFrame(values[1:], columns=values[0])
+
+    emails = df.loc[df['Preference'] == 'email', "E-mail"].tolist()
+    whatsapps = df.loc[df['Preference'] == 'whatsapp', "Whatsapp"].tolist()
+    # plans to add whatsapp notifications were postponed
+    return emails
+
+def render_notification(tag, events, note_type="schedule"):
+    # sort events by date
+    events.sort(key=lambda x: x['start'].get('dateTime', x['start'].get('date')))
+    
+    events_by_day = defaultdict(list)
+    for event in events:
+        start_date = event['start'].get('dateTime', event['start'].get('date'))
+        end_date = event['end'].get('dateTime', event['end'].get('date'))
+        
+        event['startTime'] = datetime.fromisoformat(start_date).strftime('%H:%M')
+        event['endTime'] = datetime.fromisoformat(end_date).strftime('%H:%M')
+        
+        start_date = datetime.fromisoformat(start_date).strftime('%d.%m.%Y')
         
-        events_per_tag[str(tag)].append(event)
+        events_by_day[start_date].append(event)
+    
+    # create text schedule
+    schedule_ = []
+    for day, day_events in events_by_day.items():
+        schedule_.append(
+            f"{day}\n" + '\n'.join([
+                f"{event['summary']}: {event['startTime']} - {event['endTime']}" 
+                for event in day_events
+            ])
+        )
+    
+    schedule = '\n\n'.join(schedule_)
+    if note_type == "schedule":
+        text = get_schedule_template().format(tag=tag, period="zwei nächste Wochen", schedule=schedule)
+    elif note_type == "update":
+        text = get_update_template().format(tag=tag, schedule=schedule)
+    elif note_type == "delete":
+        text = get_update_template().format(tag=tag, schedule=schedule)
+    
+    return text
+
+def notify(tenant, events, note_type="schedule", notify_tag=None): # schedule, update, delete
+    events_per_tag = group_events_by_tag(events)
     
     for tag, events in events_per_tag.items():
         if notify_tag and tag != str(notify_tag): continue # notify only specific tag
         
         # get contacts by tag
         if tag != str(None):
-            result = spreadsheets.values().get(spreadsheetId=CONTACTS_SPREADSHEET_ID, range=f"{tag}!{SPREADSHEET_RANGE}").execute()
+            result = tenant.spreadsheets.values().get(spreadsheetId=tenant.contacts_spreadsheet_id, range=f"{tag}!{SPREADSHEET_RANGE}").execute()
         else:
-            result = spreadsheets.values().get(spreadsheetId=CONTACTS_SPREADSHEET_ID, range=f"{SPREADSHEET_RANGE}").execute()
+            result = tenant.spreadsheets.values().get(spreadsheetId=tenant.contacts_spreadsheet_id, range=f"{SPREADSHEET_RANGE}").execute()
         
         values = result.get('values', [])
         logging.info("Values: %s", values)
         
-        # sort events by date
-        events.sort(key=lambda x: x['start'].get('dateTime', x['start'].get('date')))
+        text = render_notification(tag, events, note_type=note_type)
+        emails = get_email_recipients(values)
         
-        events_by_day = defaultdict(list)
-        for event in events:
-            start_date = event['start'].get('dateTime', event['start'].get('date'))
-            end_date = event['end'].get('dateTime', event['end'].get('date'))
-            
-            event['startTime'] = datetime.fromisoformat(start_date).strftime('%H:%M')
-            event['endTime'] = datetime.fromisoformat(end_date).strftime('%H:%M')
-            
-            start_date = datetime.fromisoformat(start_date).strftime('%d.%m.%Y')
-            
-            events_by_day[start_date].append(event)
-        
-        # create text schedule
-        schedule_ = []
-        for day, day_events in events_by_day.items():
-            schedule_.append(
-                f"{day}\n" + '\n'.join([
-                    f"{event['summary']}: {event['startTime']} - {event['endTime']}" 
-                    for event in day_events
-                ])
-            )
-        
-        schedule = '\n\n'.join(schedule_)
-        if note_type == "schedule":
-            text = get_schedule_template().format(tag=tag, period="zwei nächste Wochen", schedule=schedule)
-        elif note_type == "update":
-            text = get_update_template().format(tag=tag, schedule=schedule)
-        elif note_type == "delete":
-            text = get_update_template().format(tag=tag, schedule=schedule)
-        
-        # get preferred contact method
-        df = pd.DataFrame(values[1:], columns=values[0])
+        send_email(tenant, sender=tenant.sender_email, to=emails, subject=f"[{tag}] Salsa Kurs", body=text)
 
-        emails = df.loc[df['Preference'] == 'email', "E-mail"].tolist()
-        whatsapps = df.loc[df['Preference'] == 'whatsapp', "Whatsapp"].tolist()
+
+def build_digests(tenant, events, tags=None):
+    """Render schedule digests for all (or selected) tags from one list of events."""
+    events_per_tag = group_events_by_tag(events)
+    if tags:
+        events_per_tag = {tag: events_per_tag[tag] for tag in map(str, tags) if tag in events_per_tag}
+    
+    contacts = fetch_contacts(tenant, events_per_tag.keys())
+    
+    digests = []
+    for tag, tag_events in events_per_tag.items():
+        values = contacts.get(tag, [])
+        if not values:
+            logging.info("No contacts for tag %s", tag)
+            continue
+        
+        emails = get_email_recipients(values)
+        if not emails:
+            continue
         
-        send_email(sender=SENDER_EMAIL, to=emails, subject=f"[{tag}] Salsa Kurs", body=text)
-        # plans to add whatsapp notifications were postponed
+        digests.append({
+            'sender': tenant.sender_email,
+            'to': emails,
+            'subject': f"[{tag}] Salsa Kurs",
+            'body': render_notification(tag, tag_events, note_type="schedule"),
+        })
+    
+    return digests
 
 
 def process_events(events_dict, events_history):
@@ -253,16 +369,16 @@ def process_events(events_dict, events_history):
     return created, to_notify_updated, to_notify_deleted
 
 
-def update_history(events_dict, tag=None):
+def update_history(tenant, events_dict, tag=None):
     if events_dict:
         if tag == "Admin":
-            calendar_id = ADMIN_CALENDAR_ID
+            calendar_id = tenant.admin_calendar_id
         else:
-            calendar_id = CALENDAR_ID_MAPPING.get(tag, None)
+            calendar_id = tenant.calendar_id_mapping.get(tag, None)
         if calendar_id:
             # delete old events from admin history
             old_events_list = fetch_old_events(
-                calendar_id
+                tenant, calendar_id
             )
             old_events_ids = set([event['id'] for event in old_events_list])
             
@@ -275,22 +391,22 @@ def update_history(events_dict, tag=None):
     else:
         filename = 'events_history.json'
 
-    blob = bucket.blob(filename)
+    blob = tenant.bucket.blob(filename)
     blob.upload_from_string(json.dumps(events_dict), content_type='application/json')
 
 
-def update_calendar(events_dict, tag=None):
+def update_calendar(tenant, events_dict, tag=None):
     if not events_dict:
         events_dict = dict()
         
-    calendar_id = CALENDAR_ID_MAPPING.get(tag, None)
+    calendar_id = tenant.calendar_id_mapping.get(tag, None)
     if calendar_id:
         for event in events_dict.values():
-            calendar_service.events().insert(calendarId=calendar_id, body=event).execute()
+            tenant.calendar_service.events().insert(calendarId=calendar_id, body=event).execute()
 
 
-def compare_and_notify(events_dict, tag=None, log=False):
-    events_history = fetch_events_history(tag)
+def compare_and_notify(tenant, events_dict, tag=None, log=False):
+    events_history = fetch_events_history(tenant, tag)
     to_notify_updated = []
     to_notify_deleted = []
     created = []
@@ -321,16 +437,98 @@ def compare_and_notify(events_dict, tag=None, log=False):
     send_history = True
 
     if send_history:
-        update_history(events_dict, tag=tag)
+        update_history(tenant, events_dict, tag=tag)
         if tag and tag != 'Admin':
-            update_calendar(events_dict, tag=tag)
+            update_calendar(tenant, events_dict, tag=tag)
             
         if send_created and created: # temporary TODO delete
-            notify(list(events_dict.values()), note_type="schedule")
+            notify(tenant, list(events_dict.values()), note_type="schedule")
         if send_updated and to_notify_updated:
-            notify(to_notify_updated, note_type="update")
+            notify(tenant, to_notify_updated, note_type="update")
         if send_deleted and to_notify_deleted:
-            notify(to_notify_deleted, note_type="delete")
+            notify(tenant, to_notify_deleted, note_type="delete")
+
+
+def process_calendar_changes(tenant):
+    # get events list from admin calendar
+    events_list = fetch_all_events(tenant, tenant.admin_calendar_id, days=60)
+    
+    # general
+    if not PER_TAG:
+        events_dict = dict()
+        for event in events_list:
+            events_dict[event['id']] = event
+            
+        compare_and_notify(tenant, events_dict, tag='Admin', log=True) # general
+    else:
+        events_dicts = defaultdict(dict)
+        tags = set()
+        for event in events_list:
+            tag = re.search(r'\[(.*)\]', event['summary']).group(1)
+            
+            tags.add(tag)
+            events_dicts[tag][event['id']] = event
+            
+        for tag in tags:         
+            # list sheet names for the contacts spreadsheet
+            sheet_names = tenant.spreadsheets.get(spreadsheetId=tenant.contacts_spreadsheet_id).execute()['sheets']
+            if tag in [sheet['properties']['title'] for sheet in sheet_names]: # check if tag exists in sheets
+                if tag not in tenant.calendar_id_mapping: # create calendar if not exists
+                    calendar = {
+                        'summary': tag,
+                        'timeZone': 'Europe/Vienna'
+                    }
+                    created_calendar = tenant.calendar_service.calendars().insert(body=calendar).execute()
+                    tenant.calendar_id_mapping[tag] = created_calendar['id']
+                    
+                    update_calendar_mapping(tenant)
+             
+            compare_and_notify(tenant, events_dicts[tag] , tag=tag, log=False)
+
+
+def send_schedule(tenant, tag=None, start_date=None, end_date=None):
+    events_list = fetch_all_events(tenant, tenant.admin_calendar_id, days=60)
+    
+    # general
+    if True:
+        events_dict = dict()
+        for event in events_list:
+            if start_date and end_date:    
+                if 'date' in event['start']:
+                    event_start = datetime.fromisoformat(event['start']['date']).date()
+                elif 'dateTime' in event['start']:
+                    event_start = datetime.fromisoformat(event['start']['dateTime']).date()
+                    
+                if event_start >= start_date and event_start <= end_date:
+                    events_dict[event['id']] = event
+            
+                events_dict[event['id']] = event
+            else:
+                events_dict[event['id']] = event
+            
+        notify(tenant, list(events_dict.values()), note_type="schedule", notify_tag=tag)
+
+
+def send_digests(tenant, tags=None, start_date=None, end_date=None, dry_run=False):
+    events_list = fetch_all_events(tenant, tenant.admin_calendar_id, days=60)
+    
+    if start_date and end_date:
+        filtered_events = []
+        for event in events_list:
+            event_start = event['start'].get('dateTime', event['start'].get('date'))
+            event_start = datetime.fromisoformat(event_start).date()
+            
+            if start_date <= event_start <= end_date:
+                filtered_events.append(event)
+        events_list = filtered_events
+    
+    digests = build_digests(tenant, events_list, tags=tags)
+    
+    failed = []
+    if not dry_run:
+        failed = send_emails_bulk(tenant, digests)
+    
+    return digests, failed
 #endregion
 
 
@@ -346,52 +544,28 @@ def notifications():
     resource_state = request.headers.get('X-Goog-Resource-State')
     resource_id = request.headers.get('X-Goog-Resource-Id')
     calendar_uri = request.headers.get('X-Goog-Resource-Uri')
+    channel_id = request.headers.get('X-Goog-Channel-Id')
+    
+    tenant = tenants.for_channel(channel_id)
+    if tenant is None:
+        logging.info('Unknown channel: %s', channel_id)
+        return 'Unknown channel', 404
 
     if resource_state == 'exists': # Calendar exists
-        # get events list from admin calendar
-        events_list = fetch_all_events(ADMIN_CALENDAR_ID, days=60)
-        
-        # general
-        if not PER_TAG:
-            events_dict = dict()
-            for event in events_list:
-                events_dict[event['id']] = event
-                
-            compare_and_notify(events_dict, tag='Admin', log=True) # general
-        else:
-            events_dicts = defaultdict(dict)
-            tags = set()
-            for event in events_list:
-                tag = re.search(r'\[(.*)\]', event['summary']).group(1)
-                
-                tags.add(tag)
-                events_dicts[tag][event['id']] = event
-                
-            for tag in tags:         
-                # list sheet names for CONTACS_SPREADSHEET_ID
-                sheet_names = spreadsheets.get(spreadsheetId=CONTACTS_SPREADSHEET_ID).execute()['sheets']
-                if tag in [sheet['properties']['title'] for sheet in sheet_names]: # check if tag exists in sheets
-                    if tag not in CALENDAR_ID_MAPPING: # create calendar if not exists
-                        calendar = {
-                            'summary': tag,
-                            'timeZone': 'Europe/Vienna'
-                        }
-                        created_calendar = calendar_service.calendars().insert(body=calendar).execute()
-                        CALENDAR_ID_MAPPING[tag] = created_calendar['id']
-                        
-                        update_calendar_mapping()
-                 
-                compare_and_notify(events_dicts[tag] , tag=tag, log=False)
+        # one job per tenant at a time, round-robin across tenants
+        scheduler.submit(tenant.name, process_calendar_changes, tenant).result()
     
     return 'OK', 200
 
 
 @app.route('/schedule', methods=['POST'])
 def notify_schedule():
-    events_list = fetch_all_events(ADMIN_CALENDAR_ID, days=60)
-        
     request_json = request.get_json()
     
+    tenant = tenants.get(request_json.get('tenant', None))
+    if tenant is None:
+        return 'Unknown tenant', 404
+    
     tag = request_json.get('tag', None)
     
     start_date = request_json.get('start_date', None)
@@ -399,37 +573,49 @@ def notify_schedule():
     if start_date and end_date:
         start_date = datetime.fromisoformat(start_date).date()
         end_date = datetime.fromisoformat(end_date).date()
-        
-    # general
-    if True:
-        events_dict = dict()
-        for event in events_list:
-            if start_date and end_date:    
-                if 'date' in event['start']:
-                    event_start = datetime.fromisoformat(event['start']['date']).date()
-                elif 'dateTime' in event['start']:
-                    event_start = datetime.fromisoformat(event['start']['dateTime']).date()
-                    
-                if event_start >= start_date and event_start <= end_date:
-                    events_dict[event['id']] = event
-            
-                events_dict[event['id']] = event
-            else:
-                events_dict[event['id']] = event
-            
-        notify(list(events_dict.values()), note_type="schedule", notify_tag=tag)
+    
+    scheduler.submit(tenant.name, send_schedule, tenant, tag=tag, start_date=start_date, end_date=end_date).result()
         
     return 'OK', 200
 
 
-@app.teardown_appcontext # on exit
-def close_services(exception):
-    if calendar_service:
-        calendar_service.close()
-    if sheets_service:
-        sheets_service.close()
-    if gmail_service:
-        gmail_service.close()
+@app.route('/digest', methods=['POST'])
+def notify_digest():
+    '''Send schedule digests for every tag from a single events fetch'''
+    request_json = request.get_json(silent=True) or {}
+    
+    tenant = tenants.get(request_json.get('tenant', None))
+    if tenant is None:
+        return 'Unknown tenant', 404
+    
+    tags = request_json.get('tags', None)
+    if isinstance(tags, str):
+        tags = [tags]
+    if tags is not None and not isinstance(tags, list):
+        return 'tags must be a list of tags', 400
+
+    dry_run = request_json.get('dry_run', False)
+    if not isinstance(dry_run, bool):
+        return 'dry_run must be true or false', 400
+
+    start_date = request_json.get('start_date', None)
+    end_date = request_json.get('end_date', None)
+    if start_date and end_date:
+        start_date = datetime.fromisoformat(start_date).date()
+        end_date = datetime.fromisoformat(end_date).date()
+    
+    digests, failed = scheduler.submit(
+        tenant.name, send_digests, tenant, tags=tags, start_date=start_date, end_date=end_date, dry_run=dry_run
+    ).result()
+    
+    if dry_run:
+        return jsonify({'dry_run': True, 'digests': digests}), 200
+    
+    return jsonify({
+        'dry_run': False,
+        'sent': [digest['subject'] for i, digest in enumerate(digests) if i not in failed],
+        'failed': [digests[i]['subject'] for i in failed],
+    }), 200
 
 if __name__ == '__main__':
     # Run the Flask app
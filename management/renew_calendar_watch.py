@@ -8,6 +8,8 @@ from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.cloud import firestore
 
+from tenants import CHANNEL_SEPARATOR, channel_id_for
+
 
 SCOPES = [
     "https://www.googleapis.com/auth/calendar.events.owned",
@@ -23,6 +25,13 @@ DATABASE_ID = "TEMPLATE-DATABASE-ID"
 COLLECTION_ID = "TEMPLATE-COLLECTION-ID"
 
 CALENDAR_ID = "TEMPLATE-CALENDAR-ID"
+TENANT_NAME = None # tenant name in multi-tenant mode (see tenants.py), prefixes the channel id
+
+
+def is_tenant_channel(channel_id, tenant_name):
+    '''Whether the channel id was created for the tenant (and not e.g. for "<tenant_name>_other").'''
+    prefix = channel_id_for(tenant_name, "")
+    return bool(channel_id) and channel_id.startswith(prefix) and CHANNEL_SEPARATOR not in channel_id[len(prefix):]
 
 
 def main(local=False):
@@ -51,11 +60,13 @@ def main(local=False):
     watches_ref = db.collection(COLLECTION_ID)
     watches = watches_ref.stream()
     
-    # if watches exist, stop all
+    # if watches exist, stop all (in multi-tenant mode only those of this tenant)
     for watch in watches:
         watch_data = watch.to_dict()
 
         channel_id = watch_data.get('id')  # Channel ID of the watch
+        if TENANT_NAME and not is_tenant_channel(channel_id, TENANT_NAME):
+            continue
         resource_id = watch_data.get('resourceId')  # Resource ID from watch creation response
 
         # Create stop request body
@@ -76,7 +87,10 @@ def main(local=False):
     
     while num_tries < max_tries:
         # send renewal request
-        watcher_id = str(uuid.uuid4())
+        if TENANT_NAME:
+            watcher_id = channel_id_for(TENANT_NAME, uuid.uuid4().hex) # routed by channel id in management/main.py
+        else:
+            watcher_id = str(uuid.uuid4())
         request_body = {
             'id': watcher_id,
             'type': 'webhook',
@@ -0,0 +1,196 @@
+import json
+import os
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from requests.adapters import HTTPAdapter
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from googleapiclient.discovery import build
+from google.cloud import storage
+
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+    "https://www.googleapis.com/auth/calendar.events.owned",
+    "https://www.googleapis.com/auth/gmail.compose",
+    "https://www.googleapis.com/auth/devstorage.read_write"
+]
+
+TENANTS_FILE = os.getenv("TENANTS_FILE", "tenants.json") # list of tenant configs, see Tenant
+DEFAULT_TENANT = "default"
+CHANNEL_SEPARATOR = "_" # watch channel ids are "<tenant>_<uuid hex>"
+
+# connection pool shared by the storage clients of all tenants (urllib3 pools are thread-safe)
+SHARED_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+
+
+class Tenant:
+    '''Configuration, credentials, services and state of a single studio.'''
+
+    def __init__(self, name, token_file, project_id, bucketname, contacts_spreadsheet_id, admin_calendar_id, sender_email, scopes=SCOPES):
+        self.name = name
+        self.token_file = token_file
+        self.project_id = project_id
+        self.bucketname = bucketname
+        self.contacts_spreadsheet_id = contacts_spreadsheet_id
+        self.admin_calendar_id = admin_calendar_id
+        self.sender_email = sender_email
+        self.scopes = scopes
+
+        # per-tenant state
+        self.calendar_id_mapping = {}
+
+        # Google services are created on first use and kept for the process lifetime
+        self._services = {}
+        self._lock = threading.RLock()
+
+    def _service(self, name, factory):
+        service = self._services.get(name)
+        if service is None:
+            with self._lock:
+                service = self._services.get(name)
+                if service is None:
+                    service = self._services[name] = factory()
+        return service
+
+    def _build(self, api, version):
+        # bundled discovery documents, no request to the discovery service
+        return build(api, version, credentials=self.credentials, static_discovery=True, cache_discovery=False)
+
+    def _storage_client(self):
+        session = AuthorizedSession(self.credentials)
+        session.mount("https://", SHARED_ADAPTER)
+        return storage.Client(project=self.project_id, credentials=self.credentials, _http=session)
+
+    @property
+    def credentials(self):
+        return self._service('credentials', lambda: Credentials.from_authorized_user_file(self.token_file, self.scopes))
+
+    @property
+    def calendar_service(self):
+        return self._service('calendar', lambda: self._build("calendar", "v3"))
+
+    @property
+    def sheets_service(self):
+        return self._service('sheets', lambda: self._build("sheets", "v4"))
+
+    @property
+    def spreadsheets(self):
+        return self._service('spreadsheets', lambda: self.sheets_service.spreadsheets())
+
+    @property
+    def gmail_service(self):
+        return self._service('gmail', lambda: self._build("gmail", "v1"))
+
+    @property
+    def storage_client(self):
+        return self._service('storage', self._storage_client)
+
+    @property
+    def bucket(self):
+        # no metadata request, unlike storage_client.get_bucket
+        return self._service('bucket', lambda: self.storage_client.bucket(self.bucketname))
+
+    @classmethod
+    def from_dict(cls, config):
+        return cls(
+            name=config['name'],
+            token_file=config['token_file'],
+            project_id=config['project_id'],
+            bucketname=config['bucketname'],
+            contacts_spreadsheet_id=config['contacts_spreadsheet_id'],
+            admin_calendar_id=config['admin_calendar_id'],
+            sender_email=config['sender_email'],
+        )
+
+
+class TenantRegistry:
+    '''Tenants of the process, looked up by name or by webhook channel id.'''
+
+    def __init__(self, tenants):
+        self.tenants = {tenant.name: tenant for tenant in tenants}
+
+    @classmethod
+    def from_file(cls, path=TENANTS_FILE):
+        with open(path) as f:
+            configs = json.load(f)
+        return cls([Tenant.from_dict(config) for config in configs])
+
+    def __iter__(self):
+        return iter(self.tenants.values())
+
+    def __len__(self):
+        return len(self.tenants)
+
+    def get(self, name=None):
+        if name is None:
+            if len(self.tenants) == 1: # single tenant mode
+                return next(iter(self.tenants.values()))
+            return self.tenants.get(DEFAULT_TENANT)
+        return self.tenants.get(name)
+
+    def for_channel(self, channel_id):
+        '''Find the tenant of a calendar watch channel id, see `channel_id_for`.'''
+        if len(self.tenants) == 1:
+            return self.get()
+        if not channel_id or CHANNEL_SEPARATOR not in channel_id:
+            return None
+        return self.tenants.get(channel_id.rsplit(CHANNEL_SEPARATOR, 1)[0])
+
+
+def channel_id_for(tenant_name, watcher_id):
+    return f"{tenant_name}{CHANNEL_SEPARATOR}{watcher_id}"
+
+
+class FairScheduler:
+    '''
+    Runs jobs on a fixed pool of worker threads, round-robin across tenants.
+
+    At most one job per tenant runs at a time, so a busy tenant can't starve the others
+    and the (not thread-safe) services and history of a tenant are never used concurrently.
+    '''
+
+    def __init__(self, workers=4):
+        self._queues = {} # tenant name -> deque of (future, fn, args, kwargs)
+        self._ready = deque() # tenants with pending jobs and nothing running
+        self._running = set()
+        self._condition = threading.Condition()
+
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"tenant-worker-{i}", daemon=True).start()
+
+    def submit(self, tenant_name, fn, *args, **kwargs):
+        future = Future()
+        with self._condition:
+            self._queues.setdefault(tenant_name, deque()).append((future, fn, args, kwargs))
+            if tenant_name not in self._running and tenant_name not in self._ready:
+                self._ready.append(tenant_name)
+                self._condition.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._ready:
+                    self._condition.wait()
+                tenant_name = self._ready.popleft()
+                future, fn, args, kwargs = self._queues[tenant_name].popleft()
+                self._running.add(tenant_name)
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as error:
+                    logging.exception("Job of tenant %s failed", tenant_name)
+                    future.set_exception(error)
+
+            with self._condition:
+                self._running.discard(tenant_name)
+                if self._queues[tenant_name]: # back of the line
+                    self._ready.append(tenant_name)
+                    self._condition.notify()
+                else:
+                    del self._queues[tenant_name]
@@ -24,6 +24,10 @@ SPREADSHEET_RANGE = "A:C" # fields to be stored: name, email, whatsapp
 SENDER_EMAIL = "TEMPLATE-EMAIL" # email to send responses
 BUCKETNAME = "TEMPLATE-BUCKETNAME" # bucket to store courses info
 CALENDAR_BUCKETNAME = "TEMPLATE-BUCKETNAME" # bucket to store calendar current history (for calendar updates management)
+REGISTRATION_SUBJECT = "Kontaktformularanfrage" # subject of registration emails
+PROCESSED_LABEL = "Registration-Processed" # gmail label added to answered registration emails
+
+label_ids = {} # label name -> id, looked up once per instance
 
 
 #region utils
@@ -70,16 +74,46 @@ def create_email_message(sender, to, subject, body):
     return {'raw': raw_message}
 
 def send_email(gmail_service, sender, to, subject, body):
-    """Send an email message."""
+    """Send an email message, returns whether it was sent."""
     try:
         if isinstance(to, list):
             to = ', '.join(to)
         message = create_email_message(sender, to, subject, body)
         message = gmail_service.users().messages().send(userId="me", body=message).execute()
         print(f'Sent message to {to} Message Id: {message["id"]}')
+        return True
     except HttpError as error:
         print(f'An error occurred: {error}')
-        
+        return False
+
+def find_label(gmail_service, name):
+    labels = gmail_service.users().labels().list(userId='me').execute().get('labels', [])
+    for label in labels:
+        if label['name'] == name:
+            return label['id']
+    return None
+
+def get_or_create_label(gmail_service, name):
+    if name in label_ids:
+        return label_ids[name]
+    
+    label_id = find_label(gmail_service, name)
+    if label_id is None:
+        try:
+            label_id = gmail_service.users().labels().create(userId='me', body={'name': name}).execute()['id']
+        except HttpError as error:
+            if error.resp.status != 409:
+                raise
+            # created concurrently by another instance
+            label_id = find_label(gmail_service, name)
+    
+    label_ids[name] = label_id
+    return label_id
+
+def mark_processed(gmail_service, message_ids, label_id):
+    if message_ids:
+        gmail_service.users().messages().batchModify(userId='me', body={'ids': list(message_ids), 'addLabelIds': [label_id]}).execute()
+
 def get_message_by_history_id(gmail_service, start_history_id):
     # Step 1: Fetch the history of changes starting from the provided history ID
     response = gmail_service.users().history().list(
@@ -114,6 +148,67 @@ def extract_registration_info(text):
 
 def form_spreadsheet_entry(info_dict):
     return [info_dict['name'], info_dict['email'], info_dict['phone']]
+
+def get_credentials():
+    creds = json.loads(os.getenv("CREDS"))
+    if creds:
+        creds = Credentials.from_authorized_user_info(creds, SCOPES)
+        if creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+    return creds
+
+def parse_registration_message(message_info):
+    '''Registration info of a gmail message, None for other messages.'''
+    subject = None
+    headers = message_info['payload']['headers']
+    for header in headers:
+        if header['name'] == "subject":
+            subject = header['value']
+    if subject != REGISTRATION_SUBJECT:
+        return None
+    
+    content = message_info['snippet']
+    # parse content
+    return extract_registration_info(content)
+
+def get_course_tag(registration_info, tag2id):
+    tag = registration_info['course']
+    if tag2id:
+        tag = tag2id.get(tag, tag)
+    return tag
+
+def get_contacts(spreadsheets, tag):
+    '''values().get response of the course sheet, rows are in 'values'.'''
+    return spreadsheets.values().get(spreadsheetId=CONTACTS_SPREADSHEET_ID, range=f"{tag}!{SPREADSHEET_RANGE}").execute()
+
+def form_accept_answer(registration_info, tag, tag_info):
+    info = tag_info if tag_info else ""
+    return get_accept_registration_template().format(name=registration_info['name'], course=tag, info=info)
+
+def form_answer(registration_info, tag, contacts, tag_info):
+    '''Returns (accepted, answer letter text).'''
+    if check_deny_condition(contacts): # deny registration
+        return False, get_deny_registration_template().format(name=registration_info['name'], course=tag)
+    
+    # accept registration
+    return True, form_accept_answer(registration_info, tag, tag_info)
+
+def append_registrations(spreadsheets, tag, entries):
+    '''Append all entries of a course with a single values().append call.'''
+    if not entries:
+        return None
+    
+    # values to add to spreadsheet
+    body = {
+        'values': entries
+    }
+    # log changes to spreadsheet
+    return spreadsheets.values().append(
+        spreadsheetId=CONTACTS_SPREADSHEET_ID,
+        range=tag,
+        valueInputOption='RAW',
+        body=body
+    ).execute()
 #endregion
 
 @functions_framework.cloud_event
@@ -121,11 +216,7 @@ def process(cloud_event):
     '''Function to be run in Cloud Run to process registration emails.'''
     
     # sign in
-    creds = json.loads(os.getenv("CREDS"))
-    if creds:
-        creds = Credentials.from_authorized_user_info(creds, SCOPES)
-        if creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+    creds = get_credentials()
     
     # define services
     sheets_service = build("sheets", "v4", credentials=creds)
@@ -143,49 +234,25 @@ def process(cloud_event):
     message_info = get_message_by_history_id(gmail_service, response['historyId'])
     
     # check if this is a registration message
-    headers = message_info['payload']['headers']
-    for header in headers:
-        if header['name'] == "subject":
-            subject = header['value']
-        if header['name'] == "from":
-            sender = header['value']
-    if subject != "Kontaktformularanfrage":
+    registration_info = parse_registration_message(message_info)
+    if registration_info is None:
         print("Other message")
         return
     
-    content = message_info['snippet']
-    # parse content
-    registration_info = extract_registration_info(content)
-    
     # check conditions for registration
     ## get contacts info
     email = registration_info['email']
-    tag = registration_info['course'] 
-    tag2id = get_tag_mapping(calendar_bucket)
-    if tag2id:
-        tag = tag2id.get(tag, tag)
+    tag = get_course_tag(registration_info, get_tag_mapping(calendar_bucket))
     tag_info = get_tag_info(bucket, tag)
     
-    contacts = spreadsheets.values().get(spreadsheetId=CONTACTS_SPREADSHEET_ID, range=f"{tag}!{SPREADSHEET_RANGE}").execute()
-    if check_deny_condition(contacts): # deny registration
-        message = get_deny_registration_template().format(name=registration_info['name'], course=tag)
-    else: # accept registration
-        info = tag_info if tag_info else ""
-        message = get_accept_registration_template().format(name=registration_info['name'], course=tag, info=info)
-        
-        # values to add to spreadsheet
-        body = {
-            'values': [
-                [registration_info['name'], registration_info['email'], registration_info['phone']]
-            ]
-        }
-        # log changes to spreadsheet
-        result = spreadsheets.values().append(
-            spreadsheetId=CONTACTS_SPREADSHEET_ID,
-            range=tag,
-            valueInputOption='RAW',
-            body=body
-        ).execute()
+    contacts = get_contacts(spreadsheets, tag)
+    accepted, message = form_answer(registration_info, tag, contacts, tag_info)
+    if accepted:
+        append_registrations(spreadsheets, tag, [form_spreadsheet_entry(registration_info)])
     
     # send answer letter
-    send_email(gmail_service, sender=SENDER_EMAIL, to=email, subject=str(tag), body=message)
+    sent = send_email(gmail_service, sender=SENDER_EMAIL, to=email, subject=str(tag), body=message)
+    
+    # mark as answered, so backfill.py skips it
+    if sent:
+        mark_processed(gmail_service, [message_info['id']], get_or_create_label(gmail_service, PROCESSED_LABEL))
@@ -0,0 +1,197 @@
+import os
+import argparse
+import threading
+from datetime import datetime, timedelta
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from google.cloud import storage
+
+from answer_emails import (
+    SCOPES, PROJECT_ID, BUCKETNAME, CALENDAR_BUCKETNAME, SENDER_EMAIL, REGISTRATION_SUBJECT, PROCESSED_LABEL,
+    get_credentials, get_tag_mapping, get_tag_info, get_contacts, get_course_tag, get_or_create_label,
+    parse_registration_message, form_answer, form_accept_answer, form_spreadsheet_entry, append_registrations,
+    mark_processed, send_email,
+)
+
+
+LABEL_ID = "TEMPLATE-LABEL-ID" # Gmail label ID, where the registration emails are stored
+PAGE_SIZE = 500 # messages per messages.list page, maximum value
+
+
+class GmailPool:
+    '''One gmail service per worker thread, as the underlying http client is not thread-safe.'''
+
+    def __init__(self, creds):
+        self.creds = creds
+        self.local = threading.local()
+
+    def get(self):
+        if not hasattr(self.local, 'service'):
+            self.local.service = build('gmail', 'v1', credentials=self.creds, static_discovery=True, cache_discovery=False)
+        return self.local.service
+
+
+def list_message_pages(gmail_service, label_id, after, before):
+    '''Pages of message ids with the label, received in [after, before), not yet answered.'''
+    query = f"after:{after:%Y/%m/%d} before:{before:%Y/%m/%d} subject:{REGISTRATION_SUBJECT} -label:{PROCESSED_LABEL}"
+
+    messages = gmail_service.users().messages()
+    request = messages.list(userId='me', labelIds=[label_id], q=query, maxResults=PAGE_SIZE)
+    while request is not None:
+        response = request.execute()
+        message_ids = [message['id'] for message in response.get('messages', [])]
+        if message_ids:
+            yield message_ids
+        request = messages.list_next(request, response)
+
+
+def backfill_page(message_ids, gmail_pool, spreadsheets, bucket, tag2id, processed_label_id, executor, dry_run=False, contacts_cache=None, tag_info_cache=None):
+    '''
+    Answer one page of registration messages, with one sheet append per course.
+    Returns the answers sent (or, with `dry_run`, to send) and the ids of the messages whose
+    answer could not be sent; these stay unlabelled and are answered by a rerun.
+
+    `executor` is kept by the caller across pages, so its threads (and their gmail services) are reused.
+    '''
+    contacts_cache = {} if contacts_cache is None else contacts_cache
+    tag_info_cache = {} if tag_info_cache is None else tag_info_cache
+
+    def fetch(message_id):
+        return gmail_pool.get().users().messages().get(
+            userId='me', id=message_id, format='metadata', metadataHeaders=['subject']
+        ).execute()
+
+    messages = list(executor.map(fetch, message_ids))
+
+    # group registrations by course, oldest first
+    registrations = defaultdict(list)
+    for message_info in sorted(messages, key=lambda message: int(message['internalDate'])):
+        if processed_label_id in message_info.get('labelIds', []): # answered meanwhile
+            continue
+        registration_info = parse_registration_message(message_info)
+        if registration_info is None:
+            print(f"Other message {message_info['id']}")
+            continue
+        registrations[get_course_tag(registration_info, tag2id)].append((message_info['id'], registration_info))
+
+    answers = [] # (message id, email, tag, answer letter)
+    for tag, tag_registrations in registrations.items():
+        if tag not in contacts_cache:
+            contacts_cache[tag] = get_contacts(spreadsheets, tag)
+            tag_info_cache[tag] = get_tag_info(bucket, tag)
+        contacts = contacts_cache[tag]
+        rows = contacts.setdefault('values', [])
+
+        # already in the sheet (e.g. appended by a run that died before answering), answer without adding again
+        registered = {row[1].strip().lower() for row in rows[1:] if len(row) > 1}
+
+        entries = []
+        for message_id, registration_info in tag_registrations:
+            email = registration_info['email'].strip()
+            if email.lower() in registered:
+                answers.append((message_id, email, tag, form_accept_answer(registration_info, tag, tag_info_cache[tag])))
+                continue
+
+            accepted, message = form_answer(registration_info, tag, contacts, tag_info_cache[tag])
+            if accepted:
+                entry = form_spreadsheet_entry(registration_info)
+                entries.append(entry)
+                rows.append(entry)
+                registered.add(email.lower())
+            answers.append((message_id, email, tag, message))
+
+        if not dry_run:
+            append_registrations(spreadsheets, tag, entries)
+        print(f"[{tag}] {len(tag_registrations)} registrations, {len(entries)} added to the sheet")
+
+    if dry_run:
+        return answers, []
+
+    def answer(item):
+        message_id, email, tag, message = item
+        return send_email(gmail_pool.get(), sender=SENDER_EMAIL, to=email, subject=str(tag), body=message)
+
+    futures = [(item, executor.submit(answer, item)) for item in answers]
+
+    # label only what was answered, the rest is retried by the next run
+    answered, unanswered, errors = [], [], []
+    for item, future in futures:
+        try:
+            if future.result():
+                answered.append(item)
+            else:
+                unanswered.append(item[0])
+        except Exception as error:
+            unanswered.append(item[0])
+            errors.append(error)
+
+    mark_processed(gmail_pool.get(), [item[0] for item in answered], processed_label_id)
+    if errors:
+        raise errors[0]
+    return answered, unanswered
+
+
+def backfill(creds, label_id, after, before, workers=8, dry_run=False):
+    '''
+    Answer registration emails that were missed (function down, watch lapsed).
+
+    Safe to rerun: only messages whose answer was sent get the PROCESSED_LABEL and are not
+    listed again; registrants already in the course sheet are answered but not added twice.
+    '''
+    sheets_service = build("sheets", "v4", credentials=creds, static_discovery=True, cache_discovery=False)
+    spreadsheets = sheets_service.spreadsheets()
+    gmail_pool = GmailPool(creds)
+
+    storage_client = storage.Client(project=PROJECT_ID, credentials=creds)
+    bucket = storage_client.bucket(BUCKETNAME)
+    tag2id = get_tag_mapping(storage_client.bucket(CALENDAR_BUCKETNAME))
+
+    processed_label_id = get_or_create_label(gmail_pool.get(), PROCESSED_LABEL)
+
+    # list all ids first, labelling answered messages while paging would change the result pages
+    pages = list(list_message_pages(gmail_pool.get(), label_id, after, before))
+    print(f"{sum(map(len, pages))} messages to process")
+    
+    contacts_cache, tag_info_cache = {}, {}
+    total, unanswered = 0, []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for message_ids in pages:
+            answers, page_unanswered = backfill_page(
+                message_ids, gmail_pool, spreadsheets, bucket, tag2id, processed_label_id, executor,
+                dry_run=dry_run, contacts_cache=contacts_cache, tag_info_cache=tag_info_cache
+            )
+            total += len(answers)
+            unanswered.extend(page_unanswered)
+
+    print(f"{'Would answer' if dry_run else 'Answered'} {total} registrations")
+    if unanswered:
+        print(f"{len(unanswered)} answers could not be sent, rerun to retry them")
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer registration emails received while the function was not running.")
+    parser.add_argument('--after', required=True, help="first day, YYYY-MM-DD")
+    parser.add_argument('--before', help="day after the last day, YYYY-MM-DD (default: tomorrow)")
+    parser.add_argument('--label', default=LABEL_ID, help="gmail label ID of the registration emails")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--dry-run', action='store_true', help="only print what would be done")
+    parser.add_argument('--local', action='store_true', help="sign in with token.json instead of CREDS")
+    args = parser.parse_args()
+
+    # sign in
+    if args.local:
+        if os.path.exists("token.json"):
+            creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+        else:
+            raise FileNotFoundError("token.json not found")
+    else:
+        creds = get_credentials()
+
+    after = datetime.fromisoformat(args.after)
+    before = datetime.fromisoformat(args.before) if args.before else datetime.now() + timedelta(days=1)
+
+    backfill(creds, args.label, after, before, workers=args.workers, dry_run=args.dry_run)
@@ -0,0 +1,233 @@
+'''
+Smoke test of pull_worker.py against the Pub/Sub emulator, with fake gmail, sheets and storage.
+
+    gcloud beta emulators pubsub start --host-port=localhost:8085
+    PUBSUB_EMULATOR_HOST=localhost:8085 python emulator_smoke.py
+
+Publishes gmail watch notifications for registrations of two courses and checks that the worker
+answers every registration, makes one values().append per course per batch, stores the history
+id and acks the notifications. The first answer fails with 429, so its batch must be redelivered
+and answered without adding the registrant to the sheet again.
+'''
+import os
+import sys
+import json
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import httplib2
+from google.api_core.exceptions import DeadlineExceeded
+from googleapiclient.errors import HttpError
+from google.cloud import pubsub_v1
+
+import pull_worker
+from answer_emails import REGISTRATION_SUBJECT
+
+
+SMOKE_PROJECT_ID = "smoke-project"
+ACK_DEADLINE = 10 # seconds, unacked notifications are redelivered after it
+START_HISTORY_ID = 100
+REGISTRATIONS = [("Salsa", 3), ("Bachata", 2)] # course, number of registrations
+FAILED_SENDS = 1 # first answers rejected with 429, as during a registration opening
+
+
+class Request:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+
+class Resource:
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+
+class FakeGmail:
+    def __init__(self, label_id):
+        self.label_id = label_id
+        self.history_id = START_HISTORY_ID
+        self.messages = {} # id -> message
+        self.history = [] # (history id, message id)
+        self.sent = []
+        self.failed_sends = FAILED_SENDS
+        self.labels = []
+
+    def add_registration(self, course, i):
+        self.history_id += 1
+        message_id = uuid.uuid4().hex
+        snippet = f"Von: {course} Person {i} E-Mail: {course.lower()}{i}@example.com Telefon: 123 Gewünschter Kurs: {course} Nachrichtentext: Hallo"
+        self.messages[message_id] = {
+            'id': message_id,
+            'internalDate': str(self.history_id),
+            'labelIds': [self.label_id],
+            'snippet': snippet,
+            'payload': {'headers': [{'name': 'subject', 'value': REGISTRATION_SUBJECT}]},
+        }
+        self.history.append((self.history_id, message_id))
+        return self.history_id
+
+    def users(self):
+        def history_list(userId, startHistoryId, historyTypes, labelId):
+            return Request(lambda: {
+                'history': [
+                    {'id': str(history_id), 'messagesAdded': [{'message': {'id': message_id}}]}
+                    for history_id, message_id in self.history if history_id > int(startHistoryId)
+                ],
+                'historyId': str(self.history_id),
+            })
+
+        def messages_send(userId, body):
+            def run():
+                if self.failed_sends:
+                    self.failed_sends -= 1
+                    raise HttpError(httplib2.Response({'status': 429}), b"Rate limit exceeded")
+                self.sent.append(body)
+                return {'id': uuid.uuid4().hex}
+            return Request(run)
+
+        def batch_modify(userId, body):
+            def run():
+                for message_id in body['ids']:
+                    self.messages[message_id]['labelIds'].extend(body['addLabelIds'])
+            return Request(run)
+
+        return Resource(
+            getProfile=lambda userId: Request(lambda: {'historyId': str(START_HISTORY_ID)}),
+            history=lambda: Resource(list=history_list, list_next=lambda request, response: None),
+            messages=lambda: Resource(
+                get=lambda userId, id, **kwargs: Request(lambda: json.loads(json.dumps(self.messages[id]))),
+                send=messages_send,
+                batchModify=batch_modify,
+            ),
+            labels=lambda: Resource(
+                list=lambda userId: Request(lambda: {'labels': [{'name': name, 'id': name} for name in self.labels]}),
+                create=lambda userId, body: Request(lambda: self.labels.append(body['name']) or {'id': body['name']}),
+            ),
+        )
+
+
+class FakeSheets:
+    def __init__(self):
+        self.rows = defaultdict(lambda: [["Name", "E-mail", "Phone"]])
+        self.appends = [] # course of every values().append
+
+    def values(self):
+        def get(spreadsheetId, range):
+            return Request(lambda: {'values': [list(row) for row in self.rows[range.split('!')[0]]]})
+
+        def append(spreadsheetId, range, valueInputOption, body):
+            def run():
+                self.appends.append(range)
+                self.rows[range].extend(body['values'])
+            return Request(run)
+
+        return Resource(get=get, append=append)
+
+
+class FakeBlob:
+    def __init__(self, blobs, name):
+        self.blobs = blobs
+        self.name = name
+
+    def download_as_string(self):
+        return self.blobs[self.name]
+
+    def upload_from_string(self, data, content_type=None):
+        self.blobs[self.name] = data
+
+
+class FakeBucket:
+    def __init__(self):
+        self.blobs = {}
+
+    def get_blob(self, name):
+        return FakeBlob(self.blobs, name) if name in self.blobs else None
+
+    def blob(self, name):
+        return FakeBlob(self.blobs, name)
+
+
+class FakeGmailPool:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def get(self):
+        return self.gmail
+
+
+class SmokeWorker(pull_worker.PullWorker):
+    fakes = None # (gmail, sheets, calendar bucket), set before creating the worker
+
+    def build_services(self, creds):
+        gmail, sheets, calendar_bucket = self.fakes
+        self.gmail_pool = FakeGmailPool(gmail)
+        self.spreadsheets = sheets
+        self.bucket = FakeBucket()
+        self.calendar_bucket = calendar_bucket
+
+
+def main():
+    if not os.getenv("PUBSUB_EMULATOR_HOST"):
+        sys.exit("PUBSUB_EMULATOR_HOST is not set, start the Pub/Sub emulator first")
+
+    # topic and pull subscription of the gmail watch
+    suffix = uuid.uuid4().hex[:8]
+    publisher = pubsub_v1.PublisherClient()
+    subscriber = pubsub_v1.SubscriberClient()
+    topic_path = publisher.topic_path(SMOKE_PROJECT_ID, f"gmail-watch-{suffix}")
+    subscription_path = subscriber.subscription_path(SMOKE_PROJECT_ID, f"registration-{suffix}")
+    publisher.create_topic(request={"name": topic_path})
+    subscriber.create_subscription(request={"name": subscription_path, "topic": topic_path, "ack_deadline_seconds": ACK_DEADLINE})
+
+    gmail, sheets, calendar_bucket = FakeGmail("registrations"), FakeSheets(), FakeBucket()
+    SmokeWorker.fakes = (gmail, sheets, calendar_bucket)
+    worker = SmokeWorker(
+        None, subscription_id=subscription_path.rsplit('/', 1)[1], label_id="registrations",
+        batch_size=pull_worker.BATCH_SIZE, workers=4, project_id=SMOKE_PROJECT_ID
+    )
+
+    # registrations arrive after the worker started, each with its own notification
+    for course, count in REGISTRATIONS:
+        for i in range(count):
+            history_id = gmail.add_registration(course, i)
+            data = json.dumps({'emailAddress': "studio@example.com", 'historyId': history_id}).encode()
+            publisher.publish(topic_path, data).result()
+
+    total = sum(count for _, count in REGISTRATIONS)
+    acked, appends_per_batch = 0, []
+    deadline = time.time() + 60
+    while acked < total and time.time() < deadline:
+        appends_before = len(sheets.appends)
+        try:
+            processed = worker.run_once()
+        except DeadlineExceeded: # no notifications yet
+            continue
+        acked += processed
+        if len(sheets.appends) > appends_before or processed: # including batches that were redelivered
+            appends_per_batch.append(Counter(sheets.appends[appends_before:]))
+
+    assert acked == total, f"acked {acked} of {total} notifications"
+    assert not gmail.failed_sends, "the failing send was not attempted"
+    assert len(gmail.sent) == total, f"sent {len(gmail.sent)} answers for {total} registrations"
+    for course, count in REGISTRATIONS:
+        assert len(sheets.rows[course]) == count + 1, f"{course}: {sheets.rows[course]}"
+    for appends in appends_per_batch:
+        assert all(count == 1 for count in appends.values()), f"more than one append per course in a batch: {appends}"
+    assert json.loads(calendar_bucket.blobs[pull_worker.HISTORY_BLOB])['historyId'] == gmail.history_id
+
+    # a restarted worker resumes from the stored history id, not from the profile
+    assert SmokeWorker(None, subscription_id=subscription_path.rsplit('/', 1)[1], project_id=SMOKE_PROJECT_ID).history_id == gmail.history_id
+
+    # acked notifications are not redelivered after the ack deadline
+    time.sleep(ACK_DEADLINE + 2)
+    response = subscriber.pull(request={"subscription": subscription_path, "max_messages": total}, timeout=5)
+    assert not response.received_messages, f"{len(response.received_messages)} notifications redelivered"
+
+    print(f"OK: {acked} notifications in {len(appends_per_batch)} batches, appends per batch {[dict(a) for a in appends_per_batch]}")
+
+
+if __name__ == "__main__":
+    main()
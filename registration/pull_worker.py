@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google.cloud import storage
+from google.cloud import pubsub_v1
+
+from answer_emails import (
+    SCOPES, PROJECT_ID, BUCKETNAME, CALENDAR_BUCKETNAME, PROCESSED_LABEL,
+    get_credentials, get_tag_mapping, get_or_create_label,
+)
+from backfill import LABEL_ID, PAGE_SIZE, GmailPool, backfill_page
+
+
+SUBSCRIPTION_ID = "TEMPLATE-SUBSCRIPTION-ID" # pull subscription of the gmail watch topic
+BATCH_SIZE = 100 # pub/sub messages per pull
+PULL_TIMEOUT = 30 # seconds to wait for messages
+HISTORY_BLOB = "registration_history_id.json" # last processed gmail history id, in the calendar bucket
+
+
+def list_added_message_ids(gmail_service, start_history_id, label_id):
+    '''Ids of messages added to the label since the history id, and the latest history id.'''
+    history = gmail_service.users().history()
+    request = history.list(userId='me', startHistoryId=start_history_id, historyTypes=['messageAdded'], labelId=label_id)
+
+    message_ids = []
+    latest_history_id = start_history_id
+    while request is not None:
+        response = request.execute()
+        for history_record in response.get('history', []):
+            for added in history_record.get('messagesAdded', []):
+                if added['message']['id'] not in message_ids:
+                    message_ids.append(added['message']['id'])
+        latest_history_id = response.get('historyId', latest_history_id)
+        request = history.list_next(request, response)
+
+    return message_ids, latest_history_id
+
+
+class PullWorker:
+    '''
+    Long-running alternative to `process` in answer_emails.py.
+
+    Pulls gmail watch notifications in batches, answers all registrations added since the last
+    processed history id with one values().append per course and page of PAGE_SIZE messages,
+    then stores the new history id and acks the batch. If any answer could not be sent, the
+    batch is redelivered and the history id kept. Set PUBSUB_EMULATOR_HOST to run against the
+    Pub/Sub emulator, see emulator_smoke.py.
+    '''
+
+    def __init__(self, creds, subscription_id=SUBSCRIPTION_ID, label_id=LABEL_ID, batch_size=BATCH_SIZE, workers=8, project_id=PROJECT_ID):
+        self.label_id = label_id
+        self.batch_size = batch_size
+
+        # define services, once for the lifetime of the worker
+        self.subscriber = pubsub_v1.SubscriberClient()
+        self.subscription_path = self.subscriber.subscription_path(project_id, subscription_id)
+        self.executor = ThreadPoolExecutor(max_workers=workers) # its threads keep their gmail services
+        self.build_services(creds)
+
+        self.processed_label_id = get_or_create_label(self.gmail_pool.get(), PROCESSED_LABEL)
+        self.history_id = self.load_history_id()
+
+    def build_services(self, creds):
+        sheets_service = build("sheets", "v4", credentials=creds, static_discovery=True, cache_discovery=False)
+        self.spreadsheets = sheets_service.spreadsheets()
+        self.gmail_pool = GmailPool(creds)
+
+        storage_client = storage.Client(project=PROJECT_ID, credentials=creds)
+        self.bucket = storage_client.bucket(BUCKETNAME)
+        self.calendar_bucket = storage_client.bucket(CALENDAR_BUCKETNAME)
+
+    def load_history_id(self):
+        blob = self.calendar_bucket.get_blob(HISTORY_BLOB)
+        if blob:
+            return int(json.loads(blob.download_as_string())['historyId'])
+
+        # first run: start from now, earlier registrations are recovered with backfill.py
+        return int(self.gmail_pool.get().users().getProfile(userId='me').execute()['historyId'])
+
+    def save_history_id(self, history_id):
+        blob = self.calendar_bucket.blob(HISTORY_BLOB)
+        blob.upload_from_string(json.dumps({'historyId': history_id}), content_type='application/json')
+
+    def pull(self):
+        response = self.subscriber.pull(
+            request={"subscription": self.subscription_path, "max_messages": self.batch_size},
+            timeout=PULL_TIMEOUT,
+        )
+        return response.received_messages
+
+    def process_batch(self, received_messages):
+        '''Answers the registrations of a batch, returns the history id to continue from.'''
+        notifications = [json.loads(received.message.data.decode("utf-8")) for received in received_messages]
+        history_ids = [int(notification['historyId']) for notification in notifications]
+
+        try:
+            message_ids, latest_history_id = list_added_message_ids(self.gmail_pool.get(), self.history_id, self.label_id)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            # history id too old, recover these messages with backfill.py
+            print(f'History {self.history_id} is no longer available: {error}')
+            message_ids, latest_history_id = [], max(history_ids)
+
+        tag2id = get_tag_mapping(self.calendar_bucket) if message_ids else {}
+        unanswered = []
+        # pages of at most PAGE_SIZE, batchModify labels at most 1000 messages, e.g. after a long outage
+        for i in range(0, len(message_ids), PAGE_SIZE):
+            _, page_unanswered = backfill_page(
+                message_ids[i:i + PAGE_SIZE], self.gmail_pool, self.spreadsheets, self.bucket,
+                tag2id, self.processed_label_id, self.executor
+            )
+            unanswered.extend(page_unanswered)
+
+        if unanswered:
+            # keep the history id, so the batch is redelivered and these are answered then
+            raise RuntimeError(f"{len(unanswered)} answers could not be sent: {unanswered}")
+        return max(int(latest_history_id), self.history_id)
+
+    def run_once(self):
+        '''Pull and process one batch, returns the number of notifications acked.'''
+        received_messages = self.pull()
+        if not received_messages:
+            return 0
+
+        ack_ids = [received.ack_id for received in received_messages]
+        try:
+            history_id = self.process_batch(received_messages)
+            self.save_history_id(history_id)
+        except Exception as error:
+            # redeliver the batch, answered messages are skipped on retry
+            print(f'An error occurred: {error}')
+            self.subscriber.modify_ack_deadline(
+                request={"subscription": self.subscription_path, "ack_ids": ack_ids, "ack_deadline_seconds": 0}
+            )
+            return 0
+        self.history_id = history_id
+
+        self.subscriber.acknowledge(request={"subscription": self.subscription_path, "ack_ids": ack_ids})
+        print(f"Processed {len(ack_ids)} notifications")
+        return len(ack_ids)
+
+    def run(self):
+        print(f"Listening on {self.subscription_path}")
+        while True:
+            try:
+                self.run_once()
+            except Exception as error: # deadline exceeded on an idle subscription, transient errors
+                print(f'Pull failed: {error}')
+                time.sleep(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer registration emails from a Pub/Sub pull subscription.")
+    parser.add_argument('--subscription', default=SUBSCRIPTION_ID, help="pull subscription ID")
+    parser.add_argument('--label', default=LABEL_ID, help="gmail label ID of the registration emails")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--local', action='store_true', help="sign in with token.json instead of CREDS")
+    args = parser.parse_args()
+
+    # sign in
+    if args.local:
+        if os.path.exists("token.json"):
+            creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+        else:
+            raise FileNotFoundError("token.json not found")
+    else:
+        creds = get_credentials()
+
+    PullWorker(creds, args.subscription, args.label, args.batch_size, args.workers).run()